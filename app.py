@@ -1,13 +1,12 @@
 import streamlit as st
 import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
 import json
 from datetime import datetime
 from fpdf import FPDF
 import tempfile
 import os
 import requests
+from history import REQUIRED_FIELDS, open_spreadsheet, parse_cards, parse_purchases, prepare_history, filter_history, export_history
 
 # -- Set page config must be the FIRST Streamlit command --
 st.set_page_config(
@@ -135,19 +134,9 @@ def get_cached_pdf_bytes(json_string):
     with open(path, "rb") as f:
         return f.read()
 
-SCOPE = [
-    "https://spreadsheets.google.com/feeds",
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-]
-
 @st.cache_resource(ttl=300)
 def get_gsheets():
-    credentials = Credentials.from_service_account_info(
-        json.loads(st.secrets["GCP_SERVICE_ACCOUNT"]), scopes=SCOPE)
-    gc = gspread.authorize(credentials)
-    sh = gc.open("cashback_app")
+    sh = open_spreadsheet(json.loads(st.secrets["GCP_SERVICE_ACCOUNT"]))
     cards_ws = sh.worksheet("cards")
     purchases_ws = sh.worksheet("purchases")
     receipts_ws = sh.worksheet("receipts") # Added new worksheet for archive
@@ -155,17 +144,9 @@ def get_gsheets():
 
 cards_ws, purchases_ws, receipts_ws = get_gsheets()
 
+@st.cache_data(ttl=300, show_spinner=False)
 def load_cards():
-    records = cards_ws.get_all_records()
-    cards = {}
-    for row in records:
-        name = row["card_name"]
-        category = row["category"]
-        percent = float(row["cashback_percent"])
-        if name not in cards:
-            cards[name] = {}
-        cards[name][category] = percent
-    return cards
+    return parse_cards(cards_ws.get_all_records())
 
 def save_cards(cards):
     values = [["card_name", "category", "cashback_percent"]]
@@ -177,24 +158,16 @@ def save_cards(cards):
     if len(values) > 1:
         # Optimized single API call
         cards_ws.update(f"A1:C{len(values)}", values)
+    load_cards.clear()
+
+def reload_cards():
+    # Bypass the cache so edits from other sessions or the sheet itself are seen
+    load_cards.clear()
+    return load_cards()
 
+@st.cache_data(ttl=300, show_spinner=False)
 def load_purchases():
-    records = purchases_ws.get_all_records()
-    for p in records:
-        if "paid" not in p:
-            p["paid"] = False
-        if isinstance(p["paid"], str):
-            if p["paid"].lower() == "true":
-                p["paid"] = True
-            else:
-                p["paid"] = False
-        if "amount" not in p or p["amount"] == "" or p["amount"] is None:
-            p["amount"] = 0.0
-        try:
-            p["amount"] = float(p["amount"])
-        except:
-            p["amount"] = 0.0
-    return records
+    return parse_purchases(purchases_ws.get_all_records())
 
 def save_purchases(purchases):
     values = [["date", "card", "category", "amount", "paid"]]
@@ -204,6 +177,23 @@ def save_purchases(purchases):
     sheet_len = len(purchases_ws.get_all_values())
     if sheet_len > len(values):
         purchases_ws.batch_clear([f"A{len(values)+1}:E{sheet_len}"])
+    load_purchases.clear()
+
+def reload_purchases():
+    # Bypass the cache so edits from other sessions or the sheet itself are seen
+    load_purchases.clear()
+    return load_purchases()
+
+def find_purchase(purchases, idx, row):
+    """Position of the purchase shown as ``row`` in ``purchases``, or None if it is gone."""
+    def matches(p):
+        return all(str(p.get(k)) == str(row[k]) for k in ("date", "card", "category", "amount"))
+    if 0 <= idx < len(purchases) and matches(purchases[idx]):
+        return idx
+    for pos, p in enumerate(purchases):
+        if matches(p):
+            return pos
+    return None
 
 # --- Functions for Receipts Archive ---
 def load_receipts():
@@ -239,8 +229,8 @@ if "purchase_paid" not in st.session_state:
     st.session_state.purchase_paid = False
 if "add_success" not in st.session_state:
     st.session_state.add_success = False
-if "should_reset_amount" not in st.session_state:
-    st.session_state.should_reset_amount = False
+if "purchases_changed" not in st.session_state:
+    st.session_state.purchases_changed = False
 if "edit_row" not in st.session_state:
     st.session_state.edit_row = None
 if "just_paid" not in st.session_state:
@@ -266,78 +256,211 @@ def tabs_nav():
     st.markdown("---")
     return st.session_state.get("current_tab", "Add Purchase")
 
+# --- Fragments: interactions inside these rerun only the fragment ---
+def add_purchase(purchase_card, purchase_category):
+    if st.session_state.purchase_amount == 0.0:
+        return
+    new_purchase = {
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "card": purchase_card,
+        "category": purchase_category,
+        "amount": float(st.session_state.purchase_amount),
+        "paid": st.session_state.purchase_paid,
+    }
+    purchases = reload_purchases()
+    purchases.append(new_purchase)
+    save_purchases(purchases)
+    st.session_state.add_success = True
+    st.session_state.purchase_amount = 0.0
+    st.session_state.purchase_paid = False
+
+@st.fragment
+def add_purchase_form(cards):
+    card_names = list(cards.keys())
+    purchase_card = st.selectbox("Card", card_names)
+    categories = list(cards[purchase_card].keys())
+    if categories:
+        purchase_category = st.selectbox("Category", categories)
+    else:
+        st.warning("This card has no categories. Please add some in Cards tab.")
+        purchase_category = ""
+    st.number_input(
+        "Amount", min_value=0.0, step=0.01, format="%.2f",
+        key="purchase_amount"
+    )
+    st.checkbox("Paid?", value=st.session_state.purchase_paid, key="purchase_paid")
+    add_pressed = st.button("Add Purchase", use_container_width=True,
+                            on_click=add_purchase, args=(purchase_card, purchase_category))
+    if add_pressed and not st.session_state.add_success:
+        st.warning("Amount must be greater than zero.")
+    if st.session_state.add_success:
+        st.toast("Purchase added successfully!", icon="✅")
+        st.session_state.add_success = False
+
+def cancel_edit():
+    st.session_state.edit_row = None
+
+@st.fragment
+def history_row(idx, row):
+    st.markdown(
+        f"""
+        <div class="flex-table-row">
+          <div class="flex-col">{row['date_only']}</div>
+          <div class="flex-col">{row['card']}</div>
+          <div class="flex-col">{row['category']}</div>
+          <div class="flex-col amount">${row['amount']:.2f}</div>
+          <div class="flex-col cashback">${row['cashback']:.2f}</div>
+          <div class="flex-col net">${row['net']:.2f}</div>
+          <div class="flex-col paid">{row['paid_str']}</div>
+          <div class="flex-col edit">
+            {('<b>Editing…</b>' if st.session_state.get('edit_row') == idx else '')}
+          </div>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+    # Edit button logic
+    if st.session_state.get("edit_row") != idx:
+        if st.button("✏️", key=f"edit_{idx}"):
+            if st.session_state.get("edit_row") is not None:
+                # Another row's form is open: rerun the page so it closes too
+                st.session_state.edit_row = idx
+                st.rerun()
+            st.session_state.edit_row = idx
+
+    # --- EDIT FORM ---
+    if st.session_state.get("edit_row") == idx:
+        st.markdown(
+            "<div style='background:#f9fcff;border-radius:0.99em;padding:1.08em 0.8em 0.5em 0.8em;margin-bottom:1em;margin-top:-0.6em;box-shadow:0 2px 6px #e3eefa;'>",
+            unsafe_allow_html=True
+        )
+        st.write("**Edit Purchase:**")
+        colE1, colE2, colE3 = st.columns([3, 1, 1])
+        with colE1:
+            new_amount = st.number_input("Amount", value=float(row["amount"]), min_value=0.0, step=0.01, key=f"edit_amount_{idx}")
+            new_paid = st.checkbox("Paid", value=row["paid"], key=f"edit_paid_{idx}")
+        with colE2:
+            if st.button("Save", key=f"save_edit_{idx}"):
+                purchases = reload_purchases()
+                pos = find_purchase(purchases, idx, row)
+                if pos is None:
+                    st.session_state.purchases_changed = True
+                else:
+                    purchases[pos]["amount"] = new_amount
+                    purchases[pos]["paid"] = new_paid
+                    save_purchases(purchases)
+                    st.success("Purchase updated!")
+                st.session_state.edit_row = None
+                st.rerun()
+        with colE3:
+            if st.button("Delete", key=f"delete_edit_{idx}"):
+                purchases = reload_purchases()
+                pos = find_purchase(purchases, idx, row)
+                if pos is None:
+                    st.session_state.purchases_changed = True
+                else:
+                    purchases.pop(pos)
+                    save_purchases(purchases)
+                    st.success("Purchase deleted!")
+                st.session_state.edit_row = None
+                st.rerun()
+            st.button("Cancel", key=f"cancel_edit_{idx}", on_click=cancel_edit)
+        st.markdown("</div>", unsafe_allow_html=True)
+
+def rename_category(card, cat):
+    new_cat_name = st.session_state[f"editcatname_{card}_{cat}"]
+    if new_cat_name == cat or new_cat_name == "":
+        return
+    cards = reload_cards()
+    if cat in cards.get(card, {}):
+        cards[card][new_cat_name] = cards[card].pop(cat)
+        save_cards(cards)
+
+def set_category_percent(card, cat):
+    cards = reload_cards()
+    if cat in cards.get(card, {}):
+        cards[card][cat] = st.session_state[f"editcatpct_{card}_{cat}"] / 100.0
+        save_cards(cards)
+
+def remove_category(card, cat):
+    cards = reload_cards()
+    if cat in cards.get(card, {}):
+        cards[card].pop(cat)
+        save_cards(cards)
+
+def add_category(card):
+    extra_cat = st.session_state[f"extra_cat_{card}"]
+    extra_pct = st.session_state[f"extra_pct_{card}"]
+    if not extra_cat or extra_pct <= 0:
+        return
+    cards = reload_cards()
+    if card in cards:
+        cards[card][extra_cat] = extra_pct / 100.0
+        save_cards(cards)
+        st.toast(f"Added category '{extra_cat}' to {card}", icon="✅")
+
+@st.fragment
+def card_editor(card):
+    cats = load_cards().get(card)
+    if cats is None:
+        return
+    with st.expander(f"✏️ Edit Card: {card}"):
+        del_card = st.button(f"🗑️ Delete Card", key=f"delcard_{card}")
+        if del_card:
+            cards = reload_cards()
+            cards.pop(card, None)
+            save_cards(cards)
+            st.success(f"Deleted card '{card}'")
+            st.rerun()
+        for cat, pct in list(cats.items()):
+            col1, col2, col3 = st.columns([3,2,1])
+            with col1:
+                st.text_input("Category", value=cat, key=f"editcatname_{card}_{cat}",
+                              on_change=rename_category, args=(card, cat))
+            with col2:
+                st.number_input("% Cashback", 0.0, 100.0, pct*100, key=f"editcatpct_{card}_{cat}",
+                                on_change=set_category_percent, args=(card, cat))
+            with col3:
+                st.button("🗑️ Remove", key=f"removecat_{card}_{cat}",
+                          on_click=remove_category, args=(card, cat))
+        colx1, colx2, colx3 = st.columns([3,2,1])
+        with colx1:
+            st.text_input("New Category", key=f"extra_cat_{card}")
+        with colx2:
+            st.number_input("% Cashback", 0.0, 100.0, 1.0, step=0.1, key=f"extra_pct_{card}")
+        with colx3:
+            st.button("Add to Card", key=f"add_extra_{card}", on_click=add_category, args=(card,))
+
 tab = tabs_nav()
-cards = load_cards()
-purchases = load_purchases()
+# Full-app runs always read the sheets; fragment reruns reuse this data from the cache
+cards = reload_cards()
+purchases = reload_purchases()
 
 # ---- 1. Add Purchase Tab ----
 if tab == "Add Purchase":
     st.header("🟢 Add Purchase")
-    if st.session_state.get("should_reset_amount", False):
-        st.session_state.purchase_amount = 0.0
-        st.session_state.purchase_paid = False
-        st.session_state.should_reset_amount = False
-
     if not cards:
         st.info("Please add a card first in the 'Cards' tab.")
     else:
-        card_names = list(cards.keys())
-        purchase_card = st.selectbox("Card", card_names)
-        categories = list(cards[purchase_card].keys())
-        if categories:
-            purchase_category = st.selectbox("Category", categories)
-        else:
-            st.warning("This card has no categories. Please add some in Cards tab.")
-            purchase_category = ""
-        purchase_amount = st.number_input(
-            "Amount", min_value=0.0, step=0.01, format="%.2f",
-            key="purchase_amount"
-        )
-        purchase_paid = st.checkbox("Paid?", value=st.session_state.purchase_paid, key="purchase_paid")
-        add_pressed = st.button("Add Purchase", use_container_width=True)
-        if add_pressed:
-            if st.session_state.purchase_amount == 0.0:
-                st.warning("Amount must be greater than zero.")
-            else:
-                new_purchase = {
-                    "date": datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    "card": purchase_card,
-                    "category": purchase_category,
-                    "amount": float(st.session_state.purchase_amount),
-                    "paid": st.session_state.purchase_paid,
-                }
-                purchases.append(new_purchase)
-                save_purchases(purchases)
-                st.session_state.add_success = True
-                st.session_state.should_reset_amount = True
-                st.rerun()
-        if st.session_state.add_success:
-            st.toast("Purchase added successfully!", icon="✅")
-            st.session_state.add_success = False
+        add_purchase_form(cards)
 
 # ---- 2. History Tab ----
 elif tab == "History":
     st.header("📜 Purchase History")
+    if st.session_state.purchases_changed:
+        st.warning("That purchase changed in the sheet since the page loaded. The data has been reloaded, please try again.")
+        st.session_state.purchases_changed = False
 
     if not purchases:
         st.info("No purchases yet.")
     else:
         # Prepare DataFrame
         df = pd.DataFrame([
-            p for p in purchases if "card" in p and "category" in p and "amount" in p and "paid" in p
+            p for p in purchases if all(k in p for k in REQUIRED_FIELDS)
         ])
         if not df.empty:
-            def get_cashback(row):
-                try:
-                    return float(cards.get(row['card'], {}).get(row['category'], 0))
-                except Exception:
-                    return 0
-            df['cashback_percent'] = df.apply(get_cashback, axis=1)
-            df['cashback'] = df['amount'].astype(float) * df['cashback_percent']
-            df['net'] = df['amount'].astype(float) - df['cashback']
+            df = prepare_history(df, cards)
             df['paid_str'] = df['paid'].apply(lambda x: "✅" if x else "❌")
-            df['date_dt'] = pd.to_datetime(df['date'], errors='coerce')
-            df['date_only'] = df['date_dt'].dt.strftime('%Y-%m-%d')
             
             # --- SORTING: Newest to Oldest ---
             df = df.sort_values(by='date_dt', ascending=False)
@@ -351,15 +474,35 @@ elif tab == "History":
             filter_month = st.selectbox("Filter by month", ["All"] + months, key="history_month")
 
             # --- FILTER DATA ---
-            filtered = df.copy()
-            if filter_card != "All":
-                filtered = filtered[filtered['card'] == filter_card]
-            if paid_filter == "Paid only":
-                filtered = filtered[filtered['paid'] == True]
-            elif paid_filter == "Unpaid only":
-                filtered = filtered[filtered['paid'] == False]
-            if filter_month != "All":
-                filtered = filtered[filtered['date_dt'].dt.to_period('M').astype(str) == filter_month]
+            filter_kwargs = {
+                "card": None if filter_card == "All" else filter_card,
+                "paid": {"All": None, "Paid only": True, "Unpaid only": False}[paid_filter],
+                "month": None if filter_month == "All" else filter_month,
+            }
+            filtered = filter_history(df.copy(), **filter_kwargs)
+
+            # --- EXPORT FILTERED HISTORY ---
+            with st.expander("📤 Export Filtered History"):
+                export_fmt = st.radio("Format", ["CSV", "Parquet"], horizontal=True, key="export_fmt")
+                st.caption("The download is held in memory. For very large histories run "
+                           "`python history.py cashback_history.csv` instead, which writes straight to disk.")
+                if st.button("Prepare Export", key="prepare_export"):
+                    fmt = export_fmt.lower()
+                    export_path = tempfile.NamedTemporaryFile(delete=False, suffix=f".{fmt}").name
+                    try:
+                        export_history(purchases, cards, export_path, fmt, **filter_kwargs)
+                        # The file is written chunk by chunk, but st.download_button
+                        # needs the finished export in memory to serve it.
+                        with open(export_path, "rb") as export_file:
+                            st.download_button(
+                                f"⬇️ Download {export_fmt}",
+                                export_file.read(),
+                                file_name=f"cashback_history.{fmt}",
+                                mime="text/csv" if fmt == "csv" else "application/octet-stream",
+                                key="download_export"
+                            )
+                    finally:
+                        os.remove(export_path)
 
             # --- COLORS ---
             color_total = "#2874cF"
@@ -412,6 +555,7 @@ elif tab == "History":
             to_pay = filtered[filtered['paid'] == False]
             if not to_pay.empty:
                 if st.button(f"Pay All Filtered ({len(to_pay)} purchases)", type="primary"):
+                    # to_pay was built from this run's fresh read, so its positions match purchases
                     for idx in to_pay.index:
                         purchases[idx]["paid"] = True
                     save_purchases(purchases)
@@ -522,61 +666,8 @@ elif tab == "History":
 
             # --- PURCHASE ROWS ---
             if not filtered.empty:
-                for i, row in filtered.iterrows():
-                    idx = row.name
-                    st.markdown(
-                        f"""
-                        <div class="flex-table-row">
-                          <div class="flex-col">{row['date_only']}</div>
-                          <div class="flex-col">{row['card']}</div>
-                          <div class="flex-col">{row['category']}</div>
-                          <div class="flex-col amount">${row['amount']:.2f}</div>
-                          <div class="flex-col cashback">${row['cashback']:.2f}</div>
-                          <div class="flex-col net">${row['net']:.2f}</div>
-                          <div class="flex-col paid">{row['paid_str']}</div>
-                          <div class="flex-col edit">
-                            {('<b>Editing…</b>' if st.session_state.get('edit_row') == idx else '')}
-                          </div>
-                        </div>
-                        """,
-                        unsafe_allow_html=True
-                    )
-                    # Edit button logic
-                    if st.session_state.get("edit_row") != idx:
-                        if st.button("✏️", key=f"edit_{idx}"):
-                            st.session_state.edit_row = idx
-
-                    # --- EDIT FORM ---
-                    if st.session_state.get("edit_row") == idx:
-                        edit_row = df.loc[idx]
-                        st.markdown(
-                            "<div style='background:#f9fcff;border-radius:0.99em;padding:1.08em 0.8em 0.5em 0.8em;margin-bottom:1em;margin-top:-0.6em;box-shadow:0 2px 6px #e3eefa;'>",
-                            unsafe_allow_html=True
-                        )
-                        st.write("**Edit Purchase:**")
-                        colE1, colE2, colE3 = st.columns([3, 1, 1])
-                        with colE1:
-                            new_amount = st.number_input("Amount", value=float(edit_row["amount"]), min_value=0.0, step=0.01, key=f"edit_amount_{idx}")
-                            new_paid = st.checkbox("Paid", value=edit_row["paid"], key=f"edit_paid_{idx}")
-                        with colE2:
-                            if st.button("Save", key=f"save_edit_{idx}"):
-                                purchases[idx]["amount"] = new_amount
-                                purchases[idx]["paid"] = new_paid
-                                save_purchases(purchases)
-                                st.success("Purchase updated!")
-                                st.session_state.edit_row = None
-                                st.rerun()
-                        with colE3:
-                            if st.button("Delete", key=f"delete_edit_{idx}"):
-                                purchases.pop(idx)
-                                save_purchases(purchases)
-                                st.success("Purchase deleted!")
-                                st.session_state.edit_row = None
-                                st.rerun()
-                            if st.button("Cancel", key=f"cancel_edit_{idx}"):
-                                st.session_state.edit_row = None
-                                st.rerun()
-                        st.markdown("</div>", unsafe_allow_html=True)
+                for idx, row in filtered.iterrows():
+                    history_row(idx, row)
             else:
                 st.info("No purchases match your filters.")
         else:
@@ -647,45 +738,8 @@ elif tab == "Cards":
                 st.error("Enter card name and at least one category.")
 
     if cards:
-        for card, cats in list(cards.items()):
-            with st.expander(f"✏️ Edit Card: {card}"):
-                del_card = st.button(f"🗑️ Delete Card", key=f"delcard_{card}")
-                if del_card:
-                    cards.pop(card)
-                    save_cards(cards)
-                    st.success(f"Deleted card '{card}'")
-                    st.rerun()
-                for cat, pct in list(cats.items()):
-                    col1, col2, col3 = st.columns([3,2,1])
-                    with col1:
-                        new_cat_name = st.text_input("Category", value=cat, key=f"editcatname_{card}_{cat}")
-                    with col2:
-                        new_pct = st.number_input("% Cashback", 0.0, 100.0, pct*100, key=f"editcatpct_{card}_{cat}")
-                    with col3:
-                        if st.button("🗑️ Remove", key=f"removecat_{card}_{cat}"):
-                            cards[card].pop(cat)
-                            save_cards(cards)
-                            st.rerun()
-                    if new_cat_name != cat and new_cat_name != "":
-                        cards[card][new_cat_name] = cards[card].pop(cat)
-                        save_cards(cards)
-                        st.rerun()
-                    if new_pct != pct*100:
-                        cards[card][new_cat_name] = new_pct/100.0
-                        save_cards(cards)
-                        st.rerun()
-                colx1, colx2, colx3 = st.columns([3,2,1])
-                with colx1:
-                    extra_cat = st.text_input("New Category", key=f"extra_cat_{card}")
-                with colx2:
-                    extra_pct = st.number_input("% Cashback", 0.0, 100.0, 1.0, step=0.1, key=f"extra_pct_{card}")
-                with colx3:
-                    if st.button("Add to Card", key=f"add_extra_{card}"):
-                        if extra_cat and extra_pct > 0:
-                            cards[card][extra_cat] = extra_pct / 100.0
-                            save_cards(cards)
-                            st.success(f"Added category '{extra_cat}' to {card}")
-                            st.rerun()
+        for card in list(cards.keys()):
+            card_editor(card)
     else:
         st.info("No cards added yet.")
 
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import sys
+
+import pandas as pd
+
+SCOPE = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"
+]
+
+EXPORT_COLUMNS = ["date", "card", "category", "amount", "paid", "cashback_percent", "cashback", "net"]
+EXPORT_CHUNKSIZE = 5000
+REQUIRED_FIELDS = ("card", "category", "amount", "paid")
+
+
+def open_spreadsheet(service_account_info):
+    # Imported here so the History helpers stay usable without the Sheets client
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    credentials = Credentials.from_service_account_info(service_account_info, scopes=SCOPE)
+    gc = gspread.authorize(credentials)
+    return gc.open("cashback_app")
+
+
+# --- Parsing sheet records ---
+def parse_cards(records):
+    cards = {}
+    for row in records:
+        name = row["card_name"]
+        category = row["category"]
+        percent = float(row["cashback_percent"])
+        if name not in cards:
+            cards[name] = {}
+        cards[name][category] = percent
+    return cards
+
+
+def parse_purchases(records):
+    for p in records:
+        if "paid" not in p:
+            p["paid"] = False
+        if isinstance(p["paid"], str):
+            if p["paid"].lower() == "true":
+                p["paid"] = True
+            else:
+                p["paid"] = False
+        if "amount" not in p or p["amount"] == "" or p["amount"] is None:
+            p["amount"] = 0.0
+        try:
+            p["amount"] = float(p["amount"])
+        except:
+            p["amount"] = 0.0
+    return records
+
+
+# --- History DataFrame ---
+def cashback_rates(cards):
+    """Cashback rates as a Series indexed by (card, category)."""
+    tuples = [(str(card), str(cat)) for card, cats in cards.items() for cat in cats]
+    rates = [float(pct) for cats in cards.values() for pct in cats.values()]
+    index = pd.MultiIndex.from_tuples(tuples, names=["card", "category"])
+    return pd.Series(rates, index=index, dtype=float)
+
+
+def prepare_history(df, cards, rates=None):
+    """Add the computed cashback, net and date columns to a purchases DataFrame."""
+    if rates is None:
+        rates = cashback_rates(cards)
+    keys = pd.MultiIndex.from_arrays([df['card'].astype(str), df['category'].astype(str)])
+    df['cashback_percent'] = rates.reindex(keys).fillna(0.0).to_numpy()
+    df['cashback'] = df['amount'].astype(float) * df['cashback_percent']
+    df['net'] = df['amount'].astype(float) - df['cashback']
+    # Explicit format so parsing never depends on which rows share a chunk
+    df['date_dt'] = pd.to_datetime(df['date'], format='mixed', errors='coerce')
+    df['date_only'] = df['date_dt'].dt.strftime('%Y-%m-%d')
+    return df
+
+
+def filter_history(df, card=None, paid=None, month=None):
+    """Apply the History tab filters. ``None`` means no filter for that field."""
+    if card is not None:
+        # Sheets returns numeric-looking card names as numbers
+        df = df[df['card'].astype(str) == str(card)]
+    if paid is not None:
+        df = df[df['paid'] == paid]
+    if month is not None:
+        df = df[df['date_dt'].dt.to_period('M').astype(str) == month]
+    return df
+
+
+# --- Chunked export ---
+def iter_history_chunks(purchases, cards, card=None, paid=None, month=None, chunksize=EXPORT_CHUNKSIZE):
+    """Yield filtered export-ready DataFrames of at most ``chunksize`` purchases each."""
+    rates = cashback_rates(cards)
+    for start in range(0, len(purchases), chunksize):
+        rows = [p for p in purchases[start:start + chunksize] if all(k in p for k in REQUIRED_FIELDS)]
+        if not rows:
+            continue
+        chunk = prepare_history(pd.DataFrame(rows), cards, rates=rates)
+        chunk = filter_history(chunk, card=card, paid=paid, month=month)
+        if chunk.empty:
+            continue
+        chunk = chunk[EXPORT_COLUMNS].copy()
+        for col in ("date", "card", "category"):
+            chunk[col] = chunk[col].astype(str)
+        chunk['amount'] = chunk['amount'].astype(float)
+        chunk['paid'] = chunk['paid'].astype(bool)
+        yield chunk
+
+
+def write_csv(chunks, path):
+    header = True
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        for chunk in chunks:
+            chunk.to_csv(f, index=False, header=header)
+            header = False
+        if header:
+            pd.DataFrame(columns=EXPORT_COLUMNS).to_csv(f, index=False)
+
+
+def write_parquet(chunks, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("date", pa.string()),
+        ("card", pa.string()),
+        ("category", pa.string()),
+        ("amount", pa.float64()),
+        ("paid", pa.bool_()),
+        ("cashback_percent", pa.float64()),
+        ("cashback", pa.float64()),
+        ("net", pa.float64()),
+    ])
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+EXPORT_FORMATS = {
+    "csv": write_csv,
+    "parquet": write_parquet,
+}
+
+
+def export_history(purchases, cards, path, fmt="csv", card=None, paid=None, month=None, chunksize=EXPORT_CHUNKSIZE):
+    """Stream the filtered purchases with cashback and net to ``path`` as CSV or Parquet."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format '{fmt}'")
+    chunks = iter_history_chunks(purchases, cards, card=card, paid=paid, month=month, chunksize=chunksize)
+    EXPORT_FORMATS[fmt](chunks, path)
+    return path
+
+
+# --- CLI ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export purchase history with cashback and net.")
+    parser.add_argument("output", help="File to write")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default=None,
+                        help="Output format (default: from the output file extension, else csv)")
+    parser.add_argument("--card", help="Only export purchases made with this card")
+    parser.add_argument("--paid", choices=["all", "paid", "unpaid"], default="all")
+    parser.add_argument("--month", help="Only export purchases from this month (YYYY-MM)")
+    parser.add_argument("--chunksize", type=int, default=EXPORT_CHUNKSIZE)
+    parser.add_argument("--credentials",
+                        help="Service account JSON file (default: GCP_SERVICE_ACCOUNT environment variable)")
+    args = parser.parse_args(argv)
+    if args.chunksize < 1:
+        parser.error("--chunksize must be at least 1")
+
+    fmt = args.format
+    if fmt is None:
+        ext = os.path.splitext(args.output)[1].lstrip(".").lower()
+        fmt = ext if ext in EXPORT_FORMATS else "csv"
+
+    if args.credentials:
+        with open(args.credentials) as f:
+            service_account_info = json.load(f)
+    elif os.environ.get("GCP_SERVICE_ACCOUNT"):
+        service_account_info = json.loads(os.environ["GCP_SERVICE_ACCOUNT"])
+    else:
+        parser.error("pass --credentials or set GCP_SERVICE_ACCOUNT")
+
+    sh = open_spreadsheet(service_account_info)
+    cards = parse_cards(sh.worksheet("cards").get_all_records())
+    purchases = parse_purchases(sh.worksheet("purchases").get_all_records())
+
+    paid = {"all": None, "paid": True, "unpaid": False}[args.paid]
+    export_history(purchases, cards, args.output, fmt, card=args.card, paid=paid,
+                   month=args.month, chunksize=args.chunksize)
+    print(f"Exported history to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())